@@ -8,6 +8,9 @@ import base64
 import time
 from datetime import datetime
 import csv
+import json
+import hashlib
+import threading
 
 app = Flask(__name__)
 CORS(app) 
@@ -18,12 +21,31 @@ MODELS_DIR = os.path.normpath(os.path.join(BASE_DIR, "..", "demo", "models"))
 CAPTURE_DIR = os.path.normpath(os.path.join(BASE_DIR, "..", "demo", "captures"))
 os.makedirs(CAPTURE_DIR, exist_ok=True)
 METADATA_CSV = os.path.join(CAPTURE_DIR, "captures_metadata.csv")
+METADATA_HEADER = ["timestamp","filename","smile_prob","age_label","age_conf",
+                   "gender_label","gender_conf","emotion_label","emotion_conf","x","y","w","h",
+                   "phash","duplicate_of","model_version","faces"]
+
+# Captures whose perceptual hashes differ by at most this many bits (out of 64)
+# are treated as near-duplicates
+DUPLICATE_HAMMING_THRESHOLD = 6
+
+# Background re-analysis defaults: images per batch, pause between batches, and
+# how long live /api/analyze or /api/capture traffic must be quiet before a batch runs
+REANALYSIS_BATCH_SIZE = 8
+# Upper bound for images per batch and face crops per model call, so one call
+# never holds model_lock for long
+REANALYSIS_MAX_BATCH_SIZE = 32
+REANALYSIS_PAUSE = 0.05
+REANALYSIS_IDLE_GAP = 1.0
+# Re-analysis results are buffered and written to the CSV at most this often (seconds)
+REANALYSIS_FLUSH_INTERVAL = 5.0
 
 FER_ONNX = os.path.join(MODELS_DIR, "emotion-ferplus-8.onnx")
 AGE_PROTO = os.path.join(MODELS_DIR, "age_deploy.prototxt")
 AGE_MODEL = os.path.join(MODELS_DIR, "age_net.caffemodel")
 GENDER_PROTO = os.path.join(MODELS_DIR, "gender_deploy.prototxt")
 GENDER_MODEL = os.path.join(MODELS_DIR, "gender_net.caffemodel")
+FACE_CASCADE = os.path.join(MODELS_DIR, "haarcascade_frontalface_default.xml")
 
 AGE_BUCKETS = ['(0-2)','(4-6)','(8-12)','(15-20)',
                '(25-32)','(38-43)','(48-53)','(60-100)']
@@ -60,26 +82,392 @@ except Exception as e:
     gender_net = None
 
 try:
-    face_cascade = cv2.CascadeClassifier(os.path.join(MODELS_DIR, "haarcascade_frontalface_default.xml"))
+    face_cascade = cv2.CascadeClassifier(FACE_CASCADE)
     print("[OK] Face detection model loaded")
 except Exception as e:
     print(f"[ERROR] Failed to load face detection: {e}")
     face_cascade = None
 
+# The FER+ export may have a fixed batch dimension of 1
+fer_batch_dynamic = fer_sess is not None and not isinstance(fer_sess.get_inputs()[0].shape[0], int)
+
+def compute_model_version():
+    """Short content fingerprint of the model files (weights, prototxts, cascade)"""
+    digest = hashlib.sha1()
+    for path in (FER_ONNX, AGE_PROTO, AGE_MODEL, GENDER_PROTO, GENDER_MODEL, FACE_CASCADE):
+        digest.update(f"{os.path.basename(path)};".encode("utf-8"))
+        if not os.path.isfile(path):
+            continue
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()[:12]
+
+MODEL_VERSION = os.environ.get("MODEL_VERSION") or compute_model_version()
+print(f"Model version: {MODEL_VERSION}")
+
+def missing_models():
+    """Names of models that failed to load"""
+    missing = []
+    if fer_sess is None:
+        missing.append('emotion')
+    if age_net is None:
+        missing.append('age')
+    if gender_net is None:
+        missing.append('gender')
+    if face_cascade is None or face_cascade.empty():
+        missing.append('face_detection')
+    return missing
+
+# cv2.dnn nets are stateful (setInput/forward), so inference is serialized
+model_lock = threading.Lock()
+metadata_lock = threading.RLock()
+last_live_request_at = 0.0
+
 # ---------------- Utils ----------------
 def softmax(x):
-    e = np.exp(x - np.max(x))
+    e = np.exp(x - np.max(x, axis=-1, keepdims=True))
     return e / e.sum(axis=-1, keepdims=True)
 
+def note_live_request():
+    """Record live inference traffic so background jobs can back off"""
+    global last_live_request_at
+    last_live_request_at = time.time()
+
+def detect_faces(img):
+    """Return face boxes as a list of (x, y, w, h) ints"""
+    if face_cascade is None:
+        return []
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    detected_faces = face_cascade.detectMultiScale(gray, 1.1, 5, minSize=(80, 80))
+    return [tuple(int(v) for v in box) for box in detected_faces]
+
+def run_face_models(face_crops):
+    """Run emotion, age and gender models on a batch of BGR face crops.
+
+    Returns (results, complete). complete is False when a model is missing or
+    raised, in which case some results hold placeholder values.
+    """
+    complete = fer_sess is not None and age_net is not None and gender_net is not None
+    results = [{
+        'emotion': "neutral", 'emotion_confidence': 0.0,
+        'smile_probability': 0.0,
+        'age': "Unknown", 'age_confidence': 0.0,
+        'gender': "Unknown", 'gender_confidence': 0.0
+    } for _ in face_crops]
+    if not face_crops:
+        return results, complete
+    
+    with model_lock:
+        # Emotion analysis
+        if fer_sess is not None:
+            try:
+                fer_in = np.stack([
+                    cv2.resize(cv2.cvtColor(face, cv2.COLOR_BGR2GRAY), (64, 64)).astype(np.float32)/255.0
+                    for face in face_crops
+                ])[:, np.newaxis]
+                if fer_batch_dynamic:
+                    logits = fer_sess.run(None, {fer_input_name: fer_in})[0]
+                else:
+                    logits = np.concatenate([fer_sess.run(None, {fer_input_name: fer_in[i:i+1]})[0]
+                                             for i in range(len(face_crops))])
+                probs = softmax(logits.reshape(len(face_crops), -1))
+                for result, face_probs in zip(results, probs):
+                    emotion_idx = int(np.argmax(face_probs))
+                    result['emotion'] = FER_CLASSES[emotion_idx]
+                    result['emotion_confidence'] = float(face_probs[emotion_idx])
+                    result['smile_probability'] = float(face_probs[SMILE_IDX])
+            except Exception as e:
+                complete = False
+                print(f"Emotion analysis error: {e}")
+        
+        # Age and gender share the same input blob
+        blob = None
+        if age_net is not None or gender_net is not None:
+            blob = cv2.dnn.blobFromImages(face_crops, 1.0, (227, 227), MODEL_MEAN_VALUES, swapRB=False)
+        
+        # Age prediction
+        if age_net is not None:
+            try:
+                age_net.setInput(blob)
+                age_preds = age_net.forward()
+                for result, preds in zip(results, age_preds):
+                    age_idx = int(preds.argmax())
+                    result['age'] = AGE_BUCKETS[age_idx]
+                    result['age_confidence'] = float(preds[age_idx])
+            except Exception as e:
+                complete = False
+                print(f"Age prediction error: {e}")
+        
+        # Gender prediction
+        if gender_net is not None:
+            try:
+                gender_net.setInput(blob)
+                gender_preds = gender_net.forward()
+                for result, preds in zip(results, gender_preds):
+                    gender_idx = int(preds.argmax())
+                    result['gender'] = GENDER_CLASSES[gender_idx]
+                    result['gender_confidence'] = float(preds[gender_idx])
+            except Exception as e:
+                complete = False
+                print(f"Gender prediction error: {e}")
+    
+    return results, complete
+
+def analyze_faces(img, boxes):
+    """Predict attributes for every face box in an image"""
+    crops = [img[y:y+h, x:x+w] for (x, y, w, h) in boxes]
+    faces = []
+    predictions, _ = run_face_models(crops)
+    for (x, y, w, h), prediction in zip(boxes, predictions):
+        face = {'x': x, 'y': y, 'width': w, 'height': h}
+        face.update(prediction)
+        faces.append(face)
+    return faces
+
 def save_metadata(row):
-    header = ["timestamp","filename","smile_prob","age_label","age_conf",
-              "gender_label","gender_conf","emotion_label","emotion_conf","x","y","w","h"]
-    write_header = not os.path.exists(METADATA_CSV)
-    with open(METADATA_CSV, "a", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
-        if write_header: 
-            writer.writerow(header)
-        writer.writerow(row)
+    with metadata_lock:
+        write_header = not os.path.exists(METADATA_CSV)
+        with open(METADATA_CSV, "a", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            if write_header: 
+                writer.writerow(METADATA_HEADER)
+            writer.writerow(row)
+
+def read_metadata_rows():
+    """Read all metadata rows as dicts (missing columns filled with '')"""
+    with metadata_lock:
+        if not os.path.exists(METADATA_CSV):
+            return []
+        with open(METADATA_CSV, "r", newline="", encoding="utf-8") as f:
+            reader = csv.DictReader(f, restval="")
+            return [{key: row.get(key) or "" for key in METADATA_HEADER} for row in reader]
+
+def write_metadata_rows(rows):
+    """Rewrite the metadata CSV with the current header"""
+    with metadata_lock:
+        # Write to a temp file and swap it in so a crash can't truncate the metadata
+        tmp_path = METADATA_CSV + ".tmp"
+        with open(tmp_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=METADATA_HEADER, restval="", extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(rows)
+        os.replace(tmp_path, METADATA_CSV)
+
+def serialize_faces(faces):
+    """Compact JSON for the per-capture 'faces' column"""
+    return json.dumps([
+        {key: round(value, 3) if isinstance(value, float) else value for key, value in face.items()}
+        for face in faces
+    ], separators=(",", ":"))
+
+def parse_faces(text):
+    """Parse a 'faces' column, treating empty or malformed cells as no faces"""
+    try:
+        faces = json.loads(text) if text else []
+    except ValueError:
+        return []
+    return faces if isinstance(faces, list) else []
+
+def apply_analysis_to_row(row, faces):
+    """Store all faces plus the model version; the first face fills the flat columns"""
+    row['model_version'] = MODEL_VERSION
+    row['faces'] = serialize_faces(faces)
+    if not faces:
+        # Don't leave the previous model's first-face values next to the new version
+        row.update({
+            'smile_prob': 0,
+            'age_label': 'No face detected',
+            'age_conf': 0,
+            'gender_label': 'No face detected',
+            'gender_conf': 0,
+            'emotion_label': 'No face detected',
+            'emotion_conf': 0,
+            'x': 0,
+            'y': 0,
+            'w': 0,
+            'h': 0
+        })
+    else:
+        face = faces[0]
+        row.update({
+            'smile_prob': face['smile_probability'],
+            'age_label': face['age'],
+            'age_conf': face['age_confidence'],
+            'gender_label': face['gender'],
+            'gender_conf': face['gender_confidence'],
+            'emotion_label': face['emotion'],
+            'emotion_conf': face['emotion_confidence'],
+            'x': face['x'],
+            'y': face['y'],
+            'w': face['width'],
+            'h': face['height']
+        })
+    return row
+
+def update_capture_analysis(results):
+    """Apply {filename: faces} re-analysis results to the stored metadata"""
+    with metadata_lock:
+        rows = read_metadata_rows()
+        for row in rows:
+            if row['filename'] in results:
+                apply_analysis_to_row(row, results[row['filename']])
+        write_metadata_rows(rows)
+
+def migrate_metadata_csv():
+    """Upgrade an existing metadata CSV written with an older header"""
+    if not os.path.exists(METADATA_CSV):
+        return
+    with open(METADATA_CSV, "r", newline="", encoding="utf-8") as f:
+        header = next(csv.reader(f), None)
+    if header != METADATA_HEADER:
+        print("Upgrading captures metadata CSV to current header...")
+        write_metadata_rows(read_metadata_rows())
+
+# ---------------- Near-duplicate Index ----------------
+def dhash(img, hash_size=8):
+    """64-bit difference hash of an image (compares horizontally adjacent pixels)"""
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(img, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+def format_hash(value):
+    return f"{value:016x}"
+
+def parse_hash(text):
+    try:
+        return int(text, 16) if text else None
+    except ValueError:
+        return None
+
+class MultiIndexHash:
+    """Multi-index hamming lookup over 64-bit hashes.
+
+    Each hash is split into 8 one-byte segments with a table per segment. Two
+    hashes within 7 bits of each other must agree exactly on at least one
+    segment, so only captures sharing a segment need a full comparison.
+    """
+    SEGMENTS = 8
+
+    def __init__(self):
+        self.tables = [{} for _ in range(self.SEGMENTS)]
+        self.hashes = {}
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def _segments(self, value):
+        return [(value >> (8 * i)) & 0xFF for i in range(self.SEGMENTS)]
+
+    def add(self, value, key):
+        self.remove(key)
+        self.hashes[key] = value
+        for table, segment in zip(self.tables, self._segments(value)):
+            table.setdefault(segment, set()).add(key)
+
+    def remove(self, key):
+        value = self.hashes.pop(key, None)
+        if value is None:
+            return
+        for table, segment in zip(self.tables, self._segments(value)):
+            bucket = table.get(segment)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del table[segment]
+
+    def search(self, value, radius):
+        """Return [(distance, key), ...] within radius, closest first"""
+        if radius < self.SEGMENTS:
+            candidates = set()
+            for table, segment in zip(self.tables, self._segments(value)):
+                candidates.update(table.get(segment, ()))
+        else:
+            # Pigeonhole guarantee no longer holds, compare against everything
+            candidates = self.hashes.keys()
+        results = []
+        for key in candidates:
+            dist = hamming_distance(value, self.hashes[key])
+            if dist <= radius:
+                results.append((dist, key))
+        results.sort()
+        return results
+
+# Only group originals are indexed, so duplicate_of always names the root of a
+# group. pending_captures holds filenames reserved by in-flight captures
+# ({filename: hash, or None for duplicates}) until their metadata row is saved.
+phash_index = MultiIndexHash()
+phash_index_lock = threading.Lock()
+pending_captures = {}
+
+def rebuild_phash_index(rows=None):
+    """Rebuild the in-memory index from stored capture metadata"""
+    global phash_index
+    # Lock order is always metadata_lock, then phash_index_lock
+    with metadata_lock:
+        if rows is None:
+            rows = read_metadata_rows()
+        index = MultiIndexHash()
+        for row in rows:
+            value = parse_hash(row["phash"])
+            if value is not None and not row["duplicate_of"]:
+                index.add(value, row["filename"])
+        with phash_index_lock:
+            # Keep originals reserved by captures that haven't saved their row yet
+            for filename, value in pending_captures.items():
+                if value is not None:
+                    index.add(value, filename)
+            phash_index = index
+    return index
+
+def reserve_capture(value, threshold, reject_duplicates):
+    """Check for a near-duplicate and reserve a unique filename in one step.
+
+    Returns (filename, duplicate_of, distance). filename is None when the
+    capture was rejected; otherwise it must be finished with
+    finish_capture() once saved, or release_capture() if the capture fails.
+    """
+    with phash_index_lock:
+        matches = phash_index.search(value, threshold)
+        duplicate_of, distance = (matches[0][1], matches[0][0]) if matches else (None, None)
+        if duplicate_of is not None and reject_duplicates:
+            return None, duplicate_of, distance
+        
+        # Millisecond timestamps plus a counter keep burst captures from overwriting each other
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")[:-3]
+        filename = f"{timestamp}.jpg"
+        counter = 1
+        while (filename in pending_captures or filename in phash_index.hashes
+               or os.path.exists(os.path.join(CAPTURE_DIR, filename))):
+            filename = f"{timestamp}_{counter}.jpg"
+            counter += 1
+        if duplicate_of is None:
+            phash_index.add(value, filename)
+            pending_captures[filename] = value
+        else:
+            pending_captures[filename] = None
+    return filename, duplicate_of, distance
+
+def finish_capture(row):
+    """Save a reserved capture's metadata row and drop its reservation"""
+    with metadata_lock:
+        save_metadata(row)
+        with phash_index_lock:
+            pending_captures.pop(row[1], None)
+
+def release_capture(filename):
+    """Undo reserve_capture() for a capture that failed"""
+    with phash_index_lock:
+        if pending_captures.pop(filename, None) is not None:
+            phash_index.remove(filename)
+
+migrate_metadata_csv()
+rebuild_phash_index()
 
 def base64_to_image(base64_string):
     """Convert base64 string to OpenCV image"""
@@ -102,16 +490,28 @@ def base64_to_image(base64_string):
         print(f"Error converting base64 to image: {e}")
         return None
 
-def image_to_base64(img):
+def image_to_base64(img, quality=None):
     """Convert OpenCV image to base64 string"""
     try:
-        _, buffer = cv2.imencode('.jpg', img)
+        params = [cv2.IMWRITE_JPEG_QUALITY, int(quality)] if quality is not None else []
+        _, buffer = cv2.imencode('.jpg', img, params)
         img_base64 = base64.b64encode(buffer).decode('utf-8')
         return f"data:image/jpeg;base64,{img_base64}"
     except Exception as e:
         print(f"Error converting image to base64: {e}")
         return None
 
+def downscale_to_max_dim(img, max_dim):
+    """Shrink image so its longest side is at most max_dim, returning (img, scale)"""
+    h, w = img.shape[:2]
+    longest = max(h, w)
+    if not max_dim or longest <= max_dim:
+        return img, 1.0
+    scale = max_dim / float(longest)
+    small = cv2.resize(img, (max(1, int(w * scale)), max(1, int(h * scale))),
+                       interpolation=cv2.INTER_AREA)
+    return small, scale
+
 # ---------------- API Routes ----------------
 
 @app.route('/api/health', methods=['GET'])
@@ -119,6 +519,7 @@ def health_check():
     """Health check endpoint"""
     return jsonify({
         'status': 'healthy',
+        'model_version': MODEL_VERSION,
         'models': {
             'emotion': fer_sess is not None,
             'age': age_net is not None,
@@ -140,80 +541,33 @@ def analyze_frame():
         if img is None:
             return jsonify({'error': 'Invalid image data'}), 400
         
-        # Convert to grayscale for face detection
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        print(f"Image shape: {img.shape}, Gray shape: {gray.shape}")
+        note_live_request()
+        print(f"Image shape: {img.shape}")
         
         # Detect faces
+        boxes = detect_faces(img)
+        print(f"Detected {len(boxes)} faces: {boxes}")
+        
         faces = []
-        if face_cascade is not None:
-            detected_faces = face_cascade.detectMultiScale(gray, 1.1, 5, minSize=(80, 80))
-            print(f"Detected {len(detected_faces)} faces: {detected_faces}")
-            
-            for (x, y, w, h) in detected_faces:
-                print(f"Processing face at ({x}, {y}, {w}, {h})")
-                face_bgr = img[y:y+h, x:x+w]
-                
-                # Initialize default values
-                smile_prob = 0.0
-                age_label, age_conf = "Unknown", 0.0
-                gender_label, gender_conf = "Unknown", 0.0
-                emotion_label, emotion_conf = "neutral", 0.0
-                
-                # Emotion analysis
-                if fer_sess is not None:
-                    try:
-                        face_gray = cv2.resize(cv2.cvtColor(face_bgr, cv2.COLOR_BGR2GRAY), (64, 64))
-                        fer_in = np.expand_dims(np.expand_dims(face_gray.astype(np.float32)/255.0, 0), 0)
-                        logits = fer_sess.run(None, {fer_input_name: fer_in})[0].squeeze()
-                        probs = softmax(logits)
-                        emotion_idx = np.argmax(probs)
-                        emotion_label = FER_CLASSES[emotion_idx]
-                        emotion_conf = float(probs[emotion_idx])
-                        smile_prob = float(probs[SMILE_IDX])
-                        print(f"Emotion analysis: {emotion_label} ({emotion_conf:.3f}), Smile: {smile_prob:.3f}")
-                    except Exception as e:
-                        print(f"Emotion analysis error: {e}")
-                
-                # Age prediction
-                if age_net is not None:
-                    try:
-                        blob = cv2.dnn.blobFromImage(face_bgr, 1.0, (227, 227), MODEL_MEAN_VALUES, swapRB=False)
-                        age_net.setInput(blob)
-                        age_preds = age_net.forward()
-                        age_idx = age_preds[0].argmax()
-                        age_label = AGE_BUCKETS[age_idx]
-                        age_conf = float(age_preds[0][age_idx])
-                        print(f"Age prediction: {age_label} ({age_conf:.3f})")
-                    except Exception as e:
-                        print(f"Age prediction error: {e}")
-                
-                # Gender prediction
-                if gender_net is not None:
-                    try:
-                        blob = cv2.dnn.blobFromImage(face_bgr, 1.0, (227, 227), MODEL_MEAN_VALUES, swapRB=False)
-                        gender_net.setInput(blob)
-                        gender_preds = gender_net.forward()
-                        gender_idx = gender_preds[0].argmax()
-                        gender_label = GENDER_CLASSES[gender_idx]
-                        gender_conf = float(gender_preds[0][gender_idx])
-                        print(f"Gender prediction: {gender_label} ({gender_conf:.3f})")
-                    except Exception as e:
-                        print(f"Gender prediction error: {e}")
-                
-                faces.append({
-                    'x': int(x),
-                    'y': int(y),
-                    'width': int(w),
-                    'height': int(h),
-                    'emotion': emotion_label,
-                    'emotion_confidence': round(emotion_conf, 3),
-                    'smile_probability': round(smile_prob, 3),
-                    'age': age_label,
-                    'age_confidence': round(age_conf, 3),
-                    'gender': gender_label,
-                    'gender_confidence': round(gender_conf, 3)
-                })
+        for face in analyze_faces(img, boxes):
+            print(f"Face at ({face['x']}, {face['y']}, {face['width']}, {face['height']}): "
+                  f"{face['emotion']} ({face['emotion_confidence']:.3f}), "
+                  f"Smile: {face['smile_probability']:.3f}, "
+                  f"Age: {face['age']} ({face['age_confidence']:.3f}), "
+                  f"Gender: {face['gender']} ({face['gender_confidence']:.3f})")
+            faces.append({
+                'x': face['x'],
+                'y': face['y'],
+                'width': face['width'],
+                'height': face['height'],
+                'emotion': face['emotion'],
+                'emotion_confidence': round(face['emotion_confidence'], 3),
+                'smile_probability': round(face['smile_probability'], 3),
+                'age': face['age'],
+                'age_confidence': round(face['age_confidence'], 3),
+                'gender': face['gender'],
+                'gender_confidence': round(face['gender_confidence'], 3)
+            })
         
         return jsonify({
             'faces': faces,
@@ -267,14 +621,34 @@ def debug_faces():
         
         print(f"Image converted successfully, shape: {img.shape}")
         
-        # Make a copy for drawing
-        debug_img = img.copy()
+        # Rendering options:
+        #   mode='image'   - full-size frame with boxes drawn (default)
+        #   mode='preview' - frame downscaled to max_dim with boxes drawn
+        #   mode='boxes'   - box coordinates only, overlay drawn client-side
+        mode = data.get('mode', 'image')
+        if mode not in ('image', 'preview', 'boxes'):
+            return jsonify({'error': f'Invalid mode: {mode}'}), 400
+        # Only validate the options the chosen mode actually uses
+        max_dim, jpeg_quality = None, None
+        if mode == 'preview':
+            try:
+                max_dim = int(data.get('max_dim', 640))
+            except (TypeError, ValueError):
+                return jsonify({'error': 'max_dim must be an integer'}), 400
+            if max_dim <= 0:
+                return jsonify({'error': 'max_dim must be positive'}), 400
+        if mode != 'boxes':
+            try:
+                jpeg_quality = int(data.get('jpeg_quality', 95 if mode == 'image' else 70))
+            except (TypeError, ValueError):
+                return jsonify({'error': 'jpeg_quality must be an integer'}), 400
+            jpeg_quality = min(max(jpeg_quality, 1), 100)
         
         # Convert to grayscale for face detection
         gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
         print(f"Grayscale conversion done, shape: {gray.shape}")
         
-        # Detect faces and draw boxes
+        # Detect faces
         faces_info = []
         if face_cascade is not None:
             print("Running face detection...")
@@ -282,40 +656,59 @@ def debug_faces():
             print(f"Face detection complete: Found {len(detected_faces)} faces")
             
             for i, (x, y, w, h) in enumerate(detected_faces):
-                print(f"Processing face {i+1} at ({x}, {y}, {w}, {h})")
-                
-                # Draw face rectangle
-                cv2.rectangle(debug_img, (x, y), (x+w, y+h), (0, 255, 0), 2)
-                
-                # Add face number label
-                cv2.putText(debug_img, f"Face {i+1}", (x, y-10), 
-                           cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0), 2)
-                
                 faces_info.append({
                     'id': i+1,
-                    'bbox': [x, y, w, h]
+                    'bbox': [int(x), int(y), int(w), int(h)]
                 })
         
-        print("Converting debug image to base64...")
-        # Convert debug image to base64
-        debug_img_base64 = image_to_base64(debug_img)
-        
-        if debug_img_base64 is None:
-            print("ERROR: Failed to convert debug image to base64")
-            return jsonify({'error': 'Failed to convert debug image'}), 500
-        
-        print(f"Debug processing complete. Returning {len(faces_info)} faces")
-        return jsonify({
-            'debug_image': debug_img_base64,
+        response = {
             'faces': faces_info,
             'face_count': len(faces_info),
+            'mode': mode,
+            'image_size': [int(img.shape[1]), int(img.shape[0])],
             'models_loaded': {
                 'emotion': fer_sess is not None,
                 'age': age_net is not None,
                 'gender': gender_net is not None,
                 'face_detection': face_cascade is not None
             }
-        })
+        }
+        
+        if mode == 'boxes':
+            print(f"Debug processing complete. Returning {len(faces_info)} faces (boxes only)")
+            return jsonify(response)
+        
+        # The decoded frame is not needed after detection, so draw directly on it
+        # (or on the downscaled preview) instead of copying the full image
+        scale = 1.0
+        debug_img = img
+        if mode == 'preview':
+            debug_img, scale = downscale_to_max_dim(img, max_dim)
+        
+        thickness = max(1, int(round(2 * scale)))
+        for face in faces_info:
+            x, y, w, h = [int(round(v * scale)) for v in face['bbox']]
+            print(f"Drawing face {face['id']} at ({x}, {y}, {w}, {h})")
+            
+            # Draw face rectangle
+            cv2.rectangle(debug_img, (x, y), (x+w, y+h), (0, 255, 0), thickness)
+            
+            # Add face number label
+            cv2.putText(debug_img, f"Face {face['id']}", (x, y-10), 
+                       cv2.FONT_HERSHEY_SIMPLEX, 0.6 * max(scale, 0.5), (0, 255, 0), thickness)
+        
+        print("Converting debug image to base64...")
+        # Convert debug image to base64
+        debug_img_base64 = image_to_base64(debug_img, quality=jpeg_quality)
+        
+        if debug_img_base64 is None:
+            print("ERROR: Failed to convert debug image to base64")
+            return jsonify({'error': 'Failed to convert debug image'}), 500
+        
+        response['debug_image'] = debug_img_base64
+        response['scale'] = scale
+        print(f"Debug processing complete. Returning {len(faces_info)} faces")
+        return jsonify(response)
         
     except Exception as e:
         print(f"=== DEBUG ERROR ===")
@@ -339,76 +732,40 @@ def capture_photo():
         if img is None:
             return jsonify({'error': 'Invalid image data'}), 400
         
-        # ANALYZE THE IMAGE FIRST to get real AI predictions
-        # Reuse the analysis logic from analyze_frame
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        faces_data = []
+        # Near-duplicate check: 'flag' saves and marks the capture, 'reject' refuses it
+        duplicate_policy = data.get('duplicate_policy', 'flag')
+        if duplicate_policy not in ('flag', 'reject'):
+            return jsonify({'error': f'Invalid duplicate_policy: {duplicate_policy}'}), 400
+        try:
+            duplicate_threshold = int(data.get('duplicate_threshold', DUPLICATE_HAMMING_THRESHOLD))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'duplicate_threshold must be an integer'}), 400
         
-        if face_cascade is not None:
-            detected_faces = face_cascade.detectMultiScale(gray, 1.1, 5, minSize=(80, 80))
-            
-            for (x, y, w, h) in detected_faces:
-                face_bgr = img[y:y+h, x:x+w]
-                
-                # Initialize default values
-                smile_prob = 0.0
-                age_label, age_conf = "Unknown", 0.0
-                gender_label, gender_conf = "Unknown", 0.0
-                emotion_label, emotion_conf = "neutral", 0.0
-                
-                # Emotion analysis
-                if fer_sess is not None:
-                    try:
-                        face_gray = cv2.resize(cv2.cvtColor(face_bgr, cv2.COLOR_BGR2GRAY), (64, 64))
-                        fer_in = np.expand_dims(np.expand_dims(face_gray.astype(np.float32)/255.0, 0), 0)
-                        logits = fer_sess.run(None, {fer_input_name: fer_in})[0].squeeze()
-                        probs = softmax(logits)
-                        emotion_idx = np.argmax(probs)
-                        emotion_label = FER_CLASSES[emotion_idx]
-                        emotion_conf = float(probs[emotion_idx])
-                        smile_prob = float(probs[SMILE_IDX])
-                    except Exception as e:
-                        print(f"Emotion analysis error: {e}")
-                
-                # Age prediction
-                if age_net is not None:
-                    try:
-                        blob = cv2.dnn.blobFromImage(face_bgr, 1.0, (227, 227), MODEL_MEAN_VALUES, swapRB=False)
-                        age_net.setInput(blob)
-                        age_preds = age_net.forward()
-                        age_idx = age_preds[0].argmax()
-                        age_label = AGE_BUCKETS[age_idx]
-                        age_conf = float(age_preds[0][age_idx])
-                    except Exception as e:
-                        print(f"Age prediction error: {e}")
-                
-                # Gender prediction
-                if gender_net is not None:
-                    try:
-                        blob = cv2.dnn.blobFromImage(face_bgr, 1.0, (227, 227), MODEL_MEAN_VALUES, swapRB=False)
-                        gender_net.setInput(blob)
-                        gender_preds = gender_net.forward()
-                        gender_idx = gender_preds[0].argmax()
-                        gender_label = GENDER_CLASSES[gender_idx]
-                        gender_conf = float(gender_preds[0][gender_idx])
-                    except Exception as e:
-                        print(f"Gender prediction error: {e}")
-                
-                faces_data.append({
-                    'x': int(x), 'y': int(y), 'width': int(w), 'height': int(h),
-                    'emotion': emotion_label, 'emotion_confidence': emotion_conf,
-                    'smile_probability': smile_prob,
-                    'age': age_label, 'age_confidence': age_conf,
-                    'gender': gender_label, 'gender_confidence': gender_conf
-                })
+        phash = dhash(img)
+        filename, duplicate_of, duplicate_distance = reserve_capture(
+            phash, duplicate_threshold, duplicate_policy == 'reject')
+        if filename is None:
+            return jsonify({
+                'success': False,
+                'error': 'Near-duplicate capture rejected',
+                'duplicate_of': duplicate_of,
+                'duplicate_distance': duplicate_distance
+            }), 409
         
-        # Generate filename
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"{timestamp}.jpg"
-        filepath = os.path.join(CAPTURE_DIR, filename)
+    except Exception as e:
+        print(f"Capture error: {e}")
+        return jsonify({'error': f'Capture failed: {str(e)}'}), 500
+    
+    filepath = os.path.join(CAPTURE_DIR, filename)
+    try:
+        # ANALYZE THE IMAGE FIRST to get real AI predictions
+        note_live_request()
+        faces_data = analyze_faces(img, detect_faces(img))
         
         # Save image
-        cv2.imwrite(filepath, img)
+        timestamp = os.path.splitext(filename)[0]
+        if not cv2.imwrite(filepath, img):
+            raise IOError(f"Could not write {filepath}")
         
         # Use AI analysis results or fallback to provided metadata
         if faces_data and len(faces_data) > 0:
@@ -458,20 +815,33 @@ def capture_photo():
             metadata['x'],
             metadata['y'],
             metadata['w'],
-            metadata['h']
+            metadata['h'],
+            format_hash(phash),
+            duplicate_of or '',
+            MODEL_VERSION,
+            serialize_faces(faces_data)
         ]
-        save_metadata(row)
+        finish_capture(row)
         
         return jsonify({
             'success': True,
             'filename': filename,
             'filepath': filepath,
             'timestamp': timestamp,
-            'analysis': metadata
+            'analysis': metadata,
+            'faces': faces_data,
+            'model_version': MODEL_VERSION,
+            'phash': format_hash(phash),
+            'duplicate_of': duplicate_of,
+            'duplicate_distance': duplicate_distance
         })
         
     except Exception as e:
         print(f"Capture error: {e}")
+        # Release the reserved filename so later captures aren't flagged against it
+        release_capture(filename)
+        if os.path.exists(filepath):
+            os.remove(filepath)
         return jsonify({'error': f'Capture failed: {str(e)}'}), 500
 
 @app.route('/api/gallery', methods=['GET'])
@@ -502,7 +872,10 @@ def get_gallery():
                                     'gender_label': row['gender_label'],
                                     'gender_conf': float(row['gender_conf']) if row['gender_conf'] != '--' else 0,
                                     'emotion_label': row['emotion_label'],
-                                    'emotion_conf': float(row['emotion_conf']) if row['emotion_conf'] != '--' else 0
+                                    'emotion_conf': float(row['emotion_conf']) if row['emotion_conf'] != '--' else 0,
+                                    'duplicate_of': row.get('duplicate_of') or None,
+                                    'model_version': row.get('model_version') or None,
+                                    'faces': parse_faces(row.get('faces'))
                                 }
                             })
         
@@ -530,11 +903,8 @@ def clear_gallery():
                         os.remove(file_path)
         
         # Clear metadata CSV by recreating it with just headers
-        with open(METADATA_CSV, 'w', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow(['timestamp', 'filename', 'smile_prob', 'age_label', 'age_conf', 
-                           'gender_label', 'gender_conf', 'emotion_label', 'emotion_conf',
-                           'x', 'y', 'w', 'h'])
+        write_metadata_rows([])
+        rebuild_phash_index([])
         
         return jsonify({
             'success': True,
@@ -555,22 +925,28 @@ def delete_photo(filename):
             os.remove(file_path)
         
         # Remove from metadata CSV (recreate CSV without this entry)
-        if os.path.exists(METADATA_CSV):
-            # Read all entries except the one to delete
-            rows_to_keep = []
-            with open(METADATA_CSV, 'r', newline='') as f:
-                reader = csv.reader(f)
-                header = next(reader, None)
-                if header:
-                    rows_to_keep.append(header)
-                for row in reader:
-                    if len(row) > 1 and row[1] != filename:  # filename is in column 1
-                        rows_to_keep.append(row)
+        with metadata_lock:
+            new_original = None
+            if os.path.exists(METADATA_CSV):
+                rows_to_keep = [row for row in read_metadata_rows() if row['filename'] != filename]
+                
+                # Re-point duplicates of the deleted photo at the earliest remaining one
+                for row in rows_to_keep:
+                    if row['duplicate_of'] == filename:
+                        if new_original is None:
+                            new_original = row
+                            row['duplicate_of'] = ''
+                        else:
+                            row['duplicate_of'] = new_original['filename']
+                
+                write_metadata_rows(rows_to_keep)
             
-            # Write back the filtered data
-            with open(METADATA_CSV, 'w', newline='') as f:
-                writer = csv.writer(f)
-                writer.writerows(rows_to_keep)
+            with phash_index_lock:
+                phash_index.remove(filename)
+                # The promoted duplicate is now its group's original
+                promoted_hash = parse_hash(new_original['phash']) if new_original else None
+                if promoted_hash is not None:
+                    phash_index.add(promoted_hash, new_original['filename'])
         
         return jsonify({
             'success': True,
@@ -581,6 +957,264 @@ def delete_photo(filename):
         print(f"Delete photo error: {e}")
         return jsonify({'error': f'Delete failed: {str(e)}'}), 500
 
+@app.route('/api/gallery/dedupe', methods=['POST'])
+def dedupe_gallery():
+    """Find (and optionally delete) near-duplicate captures in the existing gallery"""
+    try:
+        data = request.get_json(silent=True) or {}
+        remove = data.get('remove') is True
+        try:
+            threshold = int(data.get('threshold', DUPLICATE_HAMMING_THRESHOLD))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'threshold must be an integer'}), 400
+        
+        # Backfill hashes for captures stored before hashing existed. This reads
+        # every such image, so it runs before taking metadata_lock.
+        backfilled = {}
+        for row in read_metadata_rows():
+            if parse_hash(row['phash']) is None and row['filename'] not in backfilled:
+                img = cv2.imread(os.path.join(CAPTURE_DIR, row['filename']))
+                if img is not None:
+                    backfilled[row['filename']] = dhash(img)
+        
+        with metadata_lock:
+            rows = read_metadata_rows()
+            index = MultiIndexHash()
+            kept_rows = []
+            removed_rows = []
+            groups = {}
+            hashed = 0
+        
+            # Rows are stored in capture order, so the earliest capture of each group is kept
+            for row in rows:
+                value = parse_hash(row['phash'])
+                if value is None:
+                    value = backfilled.get(row['filename'])
+                    if value is None:
+                        kept_rows.append(row)
+                        continue
+                    row['phash'] = format_hash(value)
+                    hashed += 1
+            
+                matches = index.search(value, threshold)
+                if matches:
+                    original = matches[0][1]
+                    row['duplicate_of'] = original
+                    groups.setdefault(original, []).append(row['filename'])
+                    if remove:
+                        removed_rows.append(row)
+                        continue
+                else:
+                    row['duplicate_of'] = ''
+                    index.add(value, row['filename'])
+                kept_rows.append(row)
+            
+            # Older captures could share a filename with their original, so only
+            # delete files that no kept row still points at
+            kept_files = {row['filename'] for row in kept_rows}
+            for row in removed_rows:
+                if row['filename'] in kept_files or row['filename'] == row['duplicate_of']:
+                    continue
+                file_path = os.path.join(CAPTURE_DIR, row['filename'])
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+        
+            write_metadata_rows(kept_rows)
+            rebuild_phash_index(kept_rows)
+        
+        duplicate_count = sum(len(dupes) for dupes in groups.values())
+        return jsonify({
+            'success': True,
+            'scanned': len(rows),
+            'hashed': hashed,
+            'duplicate_count': duplicate_count,
+            'removed': len(removed_rows),
+            'groups': [{'original': original, 'duplicates': dupes}
+                       for original, dupes in groups.items()]
+        })
+        
+    except Exception as e:
+        print(f"Dedupe error: {e}")
+        return jsonify({'error': f'Dedupe failed: {str(e)}'}), 500
+
+# ---------------- Background Re-analysis ----------------
+reanalysis_state = {
+    'status': 'idle',
+    'model_version': MODEL_VERSION,
+    'total': 0,
+    'processed': 0,
+    'updated': 0,
+    'failed': 0,
+    'faces': 0,
+    'started_at': None,
+    'finished_at': None,
+    'error': None
+}
+reanalysis_state_lock = threading.Lock()
+reanalysis_stop = threading.Event()
+reanalysis_thread = None
+reanalysis_start_lock = threading.Lock()
+
+def update_reanalysis_state(**changes):
+    with reanalysis_state_lock:
+        reanalysis_state.update(changes)
+
+def wait_for_idle():
+    """Block until live traffic has been quiet for REANALYSIS_IDLE_GAP; False if stopped"""
+    while time.time() - last_live_request_at < REANALYSIS_IDLE_GAP and not reanalysis_stop.is_set():
+        time.sleep(REANALYSIS_IDLE_GAP / 4)
+    return not reanalysis_stop.is_set()
+
+def reanalysis_worker(batch_size, pause):
+    """Re-run all models on stored captures not yet analyzed by MODEL_VERSION.
+
+    Results are buffered and written back every REANALYSIS_FLUSH_INTERVAL
+    seconds, so the stored model_version doubles as the checkpoint: a stopped
+    or interrupted job resumes where it left off. Batches where a model fails
+    are not written, so those captures are retried on the next run.
+    """
+    buffered = {}
+    try:
+        last_flush = time.time()
+        pending = [row['filename'] for row in read_metadata_rows()
+                   if row['model_version'] != MODEL_VERSION]
+        update_reanalysis_state(total=len(pending))
+        print(f"Re-analysis started: {len(pending)} captures pending")
+        
+        for start in range(0, len(pending), batch_size):
+            if not wait_for_idle():
+                update_reanalysis_state(status='stopped')
+                break
+            
+            batch = pending[start:start + batch_size]
+            
+            # Collect every face in the batch so the models run on whole chunks of crops
+            crops, owners, boxes_by_file = [], [], {}
+            failed = 0
+            for filename in batch:
+                img = cv2.imread(os.path.join(CAPTURE_DIR, filename))
+                if img is None:
+                    failed += 1
+                    continue
+                boxes = detect_faces(img)
+                boxes_by_file[filename] = boxes
+                for (x, y, w, h) in boxes:
+                    crops.append(img[y:y+h, x:x+w])
+                    owners.append((filename, (x, y, w, h)))
+            
+            # Run the models in bounded chunks, yielding to live traffic between them
+            predictions, complete = [], True
+            for chunk_start in range(0, len(crops), REANALYSIS_MAX_BATCH_SIZE):
+                if chunk_start and not wait_for_idle():
+                    complete = False
+                    break
+                chunk_predictions, chunk_complete = run_face_models(
+                    crops[chunk_start:chunk_start + REANALYSIS_MAX_BATCH_SIZE])
+                predictions.extend(chunk_predictions)
+                complete = complete and chunk_complete
+            if complete:
+                results = {filename: [] for filename in boxes_by_file}
+                for (filename, (x, y, w, h)), prediction in zip(owners, predictions):
+                    face = {'x': x, 'y': y, 'width': w, 'height': h}
+                    face.update(prediction)
+                    results[filename].append(face)
+                buffered.update(results)
+            else:
+                # Leave these rows unversioned so they are retried
+                results = {}
+                failed += len(boxes_by_file)
+            
+            if buffered and time.time() - last_flush >= REANALYSIS_FLUSH_INTERVAL:
+                update_capture_analysis(buffered)
+                buffered = {}
+                last_flush = time.time()
+            with reanalysis_state_lock:
+                reanalysis_state['processed'] += len(batch)
+                reanalysis_state['updated'] += len(results)
+                reanalysis_state['failed'] += failed
+                reanalysis_state['faces'] += len(crops)
+            
+            time.sleep(pause)
+        else:
+            update_reanalysis_state(status='completed')
+        
+    except Exception as e:
+        print(f"Re-analysis error: {e}")
+        update_reanalysis_state(status='failed', error=str(e))
+    
+    try:
+        if buffered:
+            update_capture_analysis(buffered)
+    except Exception as e:
+        print(f"Re-analysis flush error: {e}")
+        update_reanalysis_state(status='failed', error=str(e))
+    
+    with reanalysis_state_lock:
+        reanalysis_state['finished_at'] = datetime.now().isoformat()
+        status = reanalysis_state['status']
+    print(f"Re-analysis finished: {status}")
+
+@app.route('/api/reanalyze', methods=['POST'])
+def start_reanalysis():
+    """Start background re-analysis of stored captures with the current models"""
+    global reanalysis_thread
+    try:
+        data = request.get_json(silent=True) or {}
+        try:
+            batch_size = int(data.get('batch_size', REANALYSIS_BATCH_SIZE))
+            pause = float(data.get('pause', REANALYSIS_PAUSE))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'batch_size must be an integer and pause a number'}), 400
+        if not 0 < batch_size <= REANALYSIS_MAX_BATCH_SIZE or pause < 0:
+            return jsonify({'error': f'batch_size must be between 1 and {REANALYSIS_MAX_BATCH_SIZE} '
+                                     f'and pause non-negative'}), 400
+        
+        # Placeholder results from a missing model would overwrite real ones
+        missing = missing_models()
+        if missing:
+            return jsonify({'error': 'Models not loaded', 'missing_models': missing}), 503
+        
+        with reanalysis_start_lock:
+            if reanalysis_thread is not None and reanalysis_thread.is_alive():
+                with reanalysis_state_lock:
+                    progress = dict(reanalysis_state)
+                return jsonify({'error': 'Re-analysis already running', 'progress': progress}), 409
+            
+            reanalysis_stop.clear()
+            update_reanalysis_state(status='running', total=0, processed=0, updated=0, failed=0, faces=0,
+                                    started_at=datetime.now().isoformat(), finished_at=None, error=None)
+            reanalysis_thread = threading.Thread(target=reanalysis_worker, args=(batch_size, pause), daemon=True)
+            reanalysis_thread.start()
+        
+        with reanalysis_state_lock:
+            progress = dict(reanalysis_state)
+        return jsonify({
+            'success': True,
+            'progress': progress
+        }), 202
+        
+    except Exception as e:
+        print(f"Start re-analysis error: {e}")
+        return jsonify({'error': f'Re-analysis failed to start: {str(e)}'}), 500
+
+@app.route('/api/reanalyze/status', methods=['GET'])
+def reanalysis_status():
+    """Report background re-analysis progress"""
+    with reanalysis_state_lock:
+        progress = dict(reanalysis_state)
+    return jsonify(progress)
+
+@app.route('/api/reanalyze/stop', methods=['POST'])
+def stop_reanalysis():
+    """Ask the background re-analysis to stop after its current batch"""
+    reanalysis_stop.set()
+    with reanalysis_state_lock:
+        progress = dict(reanalysis_state)
+    return jsonify({
+        'success': True,
+        'progress': progress
+    })
+
 if __name__ == '__main__':
     print("Starting Emotion Detection API Server...")
     print("Available endpoints:")
@@ -589,5 +1223,8 @@ if __name__ == '__main__':
     print("  POST /api/debug-faces - Debug face detection with visualization")
     print("  POST /api/capture - Capture and save photo")
     print("  GET  /api/gallery - Get captured photos")
+    print("  POST /api/gallery/dedupe - Find or remove near-duplicate captures")
+    print("  POST /api/reanalyze - Re-analyze stored captures in the background")
+    print("  GET  /api/reanalyze/status - Re-analysis progress")
     print("\nServer running on http://localhost:5000")
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file